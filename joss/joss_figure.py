@@ -69,7 +69,7 @@ for param in tqdm(sampler[idx]):
     ax1.plot(sf.time_data_fine, sf.dc14_fine(params=param), alpha=0.05, color="g")
 
 for param in tqdm(sampler[idx][:30]):
-    ax2.plot(sf.time_data_fine, sf.production(sf.time_data_fine, *param), alpha=0.2, color="g")
+    ax2.plot(sf.time_data_fine, sf.production(sf.time_data_fine, param), alpha=0.2, color="g")
 
 ax1.errorbar(sf.time_data + sf.time_offset, sf.d14c_data, yerr=sf.d14c_data_error, 
              fmt="ok", capsize=3, markersize=6, elinewidth=3, label="$\Delta^{14}$C data")
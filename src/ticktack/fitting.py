@@ -1,6 +1,16 @@
+import jax
 import jax.numpy as jnp
-from jax import grad, jit, random, jacrev, vmap
-from jax.lax import cond, sub
+from jax import grad, jit, random, jacrev, vmap, value_and_grad
+from jax.lax import cond, sub, scan
+from jax import lax
+from jax.scipy.linalg import cho_solve
+from jax.sharding import Mesh, PartitionSpec
+try:
+    from jax import shard_map
+    _SHARD_MAP_UNCHECKED = {'check_vma': False}
+except ImportError:
+    from jax.experimental.shard_map import shard_map
+    _SHARD_MAP_UNCHECKED = {'check_rep': False}
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,13 +23,14 @@ import ticktack
 
 import diffrax 
 from jax_cosmo.scipy.interpolate import InterpolatedUnivariateSpline
-from tinygp import kernels, GaussianProcess
+from tinygp import kernels
 
 from functools import partial
 
 from astropy.table import Table
 from tqdm import tqdm
 import emcee
+import blackjax
 
 from chainconsumer import ChainConsumer, Chain, PlotConfig
 
@@ -30,6 +41,12 @@ import seaborn as sns
 
 import os
 
+# angular frequency of the 11 year solar cycle
+_SOLAR_FREQUENCY = 2 * np.pi / 11
+# width of the exponent 16 super gaussian relative to the duration of the event
+_SUPER_GAUSSIAN_WIDTH = 1. / 1.93516
+# the control-points Gaussian Process kernel has no free hyperparameters
+_GP_KERNEL = kernels.Matern32(1.)
 
 
 class CarbonFitter:
@@ -37,7 +54,7 @@ class CarbonFitter:
     Parent class of SingleFitter and MultiFitter. Does Monte Carlo sampling, plotting and more.
     """
 
-    def MarkovChainSampler(self, params, likelihood, burnin=500, production=1000, k=2, args=()):
+    def MarkovChainSampler(self, params, likelihood, burnin=500, production=1000, k=2, args=(), vectorize=True):
         """
         Runs an affine-invariant MCMC sampler on an array of initial parameters, subject to some likelihood function.
         Parameters
@@ -52,6 +69,10 @@ class CarbonFitter:
             Number of steps to run in production period. 1000 by default.
         k: int, optional
             Number of walkers per parameter. 2 by default.
+        vectorize : bool, optional
+            If True, the likelihood of all walkers is evaluated in a single batched (vmap) call per step. Requires
+            likelihood to be a JAX function. If False, likelihood is called as is, one walker at a time, so it may be
+            any Python function. True by default.
         Returns
         -------
         ndarray
@@ -59,7 +80,12 @@ class CarbonFitter:
         """
         initial = params
         ndim, nwalkers = len(initial), k * len(initial)
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, likelihood, args=args)
+        if vectorize:
+            compiled_likelihood = self.compile_likelihood(likelihood, n_args=len(args), vectorize=True)
+            log_prob = lambda p, *args: np.asarray(compiled_likelihood(jnp.asarray(p), *args))
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, log_prob, args=args, vectorize=True)
+        else:
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, likelihood, args=args)
 
         print("Running burn-in...")
         p0 = initial + 1e-5 * np.random.rand(nwalkers, ndim)
@@ -70,6 +96,252 @@ class CarbonFitter:
         sampler.run_mcmc(p0, production, progress=True);
         return sampler.get_chain(flat=True)
 
+    def NUTSSampler(self, params, likelihood, burnin=500, production=1000, num_chains=4, args=(), seed=0):
+        """
+        Runs a No-U-Turn (NUTS) Hamiltonian Monte Carlo sampler on an array of initial parameters, subject to some
+        likelihood function. The step size and mass matrix are tuned by window adaptation during burn-in, and all
+        chains run inside a single compiled loop, batched as in batched and split across devices as in sharded.
+        Parameters
+        ----------
+        params : ndarray
+            Initial parameters for the sampler
+        likelihood : callable
+            Log-likelihood function for params. Must be a differentiable JAX function
+        burnin : int, optional
+            Number of adaptation steps to run in burn-in period. 500 by default.
+        production : int, optional
+            Number of steps to run in production period. 1000 by default.
+        num_chains : int, optional
+            Number of independent chains. 4 by default.
+        seed : int, optional
+            Seed for the random number generator. 0 by default.
+        Returns
+        -------
+        ndarray
+            A chain of MCMC walk
+        """
+        initial = jnp.asarray(params)
+        logdensity = lambda p: likelihood(p, *args)
+        warmup_key, sample_key, init_key = random.split(random.PRNGKey(seed), 3)
+        p0 = initial + 1e-5 * random.uniform(init_key, (num_chains, initial.size))
+
+        def run_chain(position, warmup_key, sample_key):
+            warmup = blackjax.window_adaptation(blackjax.nuts, logdensity)
+            (state, parameters), _ = warmup.run(warmup_key, position, num_steps=burnin)
+            kernel = blackjax.nuts(logdensity, **parameters)
+
+            def one_step(state, key):
+                state, _ = kernel.step(key, state)
+                return state, state.position
+
+            _, positions = scan(one_step, state, random.split(sample_key, production))
+            return positions
+
+        print("Running NUTS...")
+        run_chains = self.sharded(self.batched(lambda chain: run_chain(*chain)))
+        chains = jit(run_chains)((p0, random.split(warmup_key, num_chains), random.split(sample_key, num_chains)))
+        return np.asarray(jnp.swapaxes(chains, 0, 1).reshape(-1, initial.size))
+
+    def compile_likelihood(self, likelihood, n_args=0, vectorize=True):
+        """
+        Jit-compiles a log-likelihood function, batched over its first argument. Compiled functions are cached on the
+        fitter, so every sampler run with the same likelihood reuses one executable. The cache is cleared by
+        clear_jit_caches. If vectorize is False, likelihood is returned unchanged, so it need not be a JAX function.
+        Parameters
+        ----------
+        likelihood : callable
+            Log-likelihood function, taking params followed by n_args further arguments
+        n_args : int, optional
+            Number of arguments passed to likelihood after params. 0 by default.
+        vectorize : bool, optional
+            If True, batch the likelihood over a leading walker axis of params and split walkers across devices
+            (see sharded). True by default.
+        Returns
+        -------
+        callable
+            Compiled log-likelihood function
+        """
+        if not vectorize:
+            return likelihood
+        if not hasattr(self, 'compiled_likelihoods'):
+            self.compiled_likelihoods = {}
+        key = (likelihood, n_args)
+        if key not in self.compiled_likelihoods:
+            self.compiled_likelihoods[key] = jit(self.sharded(self.batched(likelihood), n_args=n_args))
+        return self.compiled_likelihoods[key]
+
+    def clear_jit_caches(self):
+        """
+        Drops the compiled versions of the jitted methods of this fitter. These take the fitter as a static argument,
+        so the compiled code closes over the production rate model and the data at trace time and would otherwise be
+        reused after either changes. Each jitted method is replaced by a freshly jitted copy bound to this fitter, which
+        leaves the compiled code of other fitters alone. The production rate model is wrapped in a new function as well,
+        since the jitted methods of the carbon box model take it as a static argument. Called whenever the data or the
+        production rate model is (re)loaded.
+        """
+        self.compiled_likelihoods = {}
+        rebound = {}
+        seen = set()
+        for cls in type(self).__mro__:
+            for name, method in vars(cls).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if hasattr(method, 'clear_cache'):
+                    stale = vars(self).get(name)
+                    setattr(self, name, jit(partial(method.__wrapped__, self)))
+                    if stale is not None:
+                        rebound[stale] = getattr(self, name)
+        production = getattr(self, 'production', None)
+        if production is not None:
+            if isinstance(production, partial):
+                production = production.func
+            self.production = partial(rebound.get(production, production))
+
+    def batched(self, fun):
+        """
+        Batches a function of production rate model parameters over the leading axis of its first argument. Further
+        arguments are shared by every row. Rows are batched with vmap, except when the burn-in state is cached (see
+        burnin_state): the cond choosing between the cached state and a full burn-in integration would be evaluated
+        on both branches under vmap, so rows are mapped in sequence within the same compiled call instead.
+        Parameters
+        ----------
+        fun : callable
+            Function taking params followed by any further arguments
+        Returns
+        -------
+        callable
+            Function taking params with one set of parameters per row, followed by the same further arguments
+        """
+        if getattr(self, 'burnin_basis', None) is None:
+            return lambda params, *args: vmap(fun, in_axes=(0,) + (None,) * len(args))(params, *args)
+        return lambda params, *args: lax.map(lambda row: fun(row, *args), params)
+
+    def sharded(self, fun, n_args=0):
+        """
+        Splits a batched function of production rate model parameters across all local devices, each device
+        evaluating an equal share of the rows. Further arguments are replicated on every device. The split is decided
+        from the number of rows of each call (emcee, for one, evaluates half of the ensemble at a time), and calls
+        whose rows do not divide evenly across the devices are evaluated unsplit.
+        Parameters
+        ----------
+        fun : callable
+            Batched function taking params, with one set of parameters per row, followed by n_args further arguments
+        n_args : int, optional
+            Number of arguments passed to fun after params. 0 by default.
+        Returns
+        -------
+        callable
+            fun split across devices, or fun itself if there is a single device
+        """
+        devices = jax.local_devices()
+        if len(devices) == 1:
+            return fun
+        mesh = Mesh(np.array(devices), ('batch',))
+        split = shard_map(fun, mesh=mesh, in_specs=(PartitionSpec('batch'),) + (PartitionSpec(),) * n_args,
+                          out_specs=PartitionSpec('batch'), **_SHARD_MAP_UNCHECKED)
+
+        def run(params, *args):
+            if jax.tree_util.tree_leaves(params)[0].shape[0] % len(devices) != 0:
+                return fun(params, *args)
+            return split(params, *args)
+        return run
+
+    @partial(jit, static_argnums=(0,))
+    def log_prior(self, params, low_bounds, up_bounds):
+        """
+        Computes the log of a uniform prior on production rate model parameters, up to a constant.
+        Parameters
+        ----------
+        params : ndarray
+            Production rate model parameters
+        low_bounds : ndarray
+            Lower bound of params
+        up_bounds : ndarray
+            Upper bound of params
+        Returns
+        -------
+        float
+            0 if all params are within their bounds, -inf otherwise
+        """
+        return jnp.where(jnp.any((params < low_bounds) | (params > up_bounds)), -jnp.inf, 0.)
+
+    def compile_gp(self):
+        """
+        Precomputes the Cholesky factor and the inverse of the Gaussian Process covariance matrix on
+        self.control_points_time. The kernel has no free hyperparameters, so both are shared by every evaluation of
+        the control-points model.
+        """
+        cov = _GP_KERNEL(self.control_points_time, self.control_points_time)
+        jitter = jnp.sqrt(jnp.finfo(cov.dtype).eps)
+        self.gp_cholesky = jnp.linalg.cholesky(cov + jitter * jnp.eye(cov.shape[0]))
+        self.gp_weights = cho_solve((self.gp_cholesky, True), jnp.eye(cov.shape[0]))
+
+    def compile_burnin(self):
+        """
+        Precomputes the response of the burn-in period to the 11 year solar cycle. Production rate models made of a
+        steady state, a solar sinusoid and a spike after the burn-in period drive a linear system, so the contents of
+        the boxes at the end of the burn-in period are the steady state plus a combination of the responses to sin and
+        cos forcing, weighted by the amplitude and phase of the solar cycle. Only adaptive fitters start the event from
+        the burn-in state, so the response is only precomputed for those.
+        """
+        def production(t, a, b):
+            return self.steady_state_production + a * jnp.sin(_SOLAR_FREQUENCY * t) + b * jnp.cos(_SOLAR_FREQUENCY * t)
+
+        basis = []
+        for args in ((1., 0.), (0., 1.)):
+            box_values, _ = self.cbm.run_rk4(self.burn_in_time, production, y0=self.steady_state_y0, args=args,
+                                             steady_state_production=self.steady_state_production)
+            basis.append(box_values[-1, :] - self.steady_state_y0)
+        self.burnin_basis = jnp.stack(basis)
+
+    @partial(jit, static_argnums=(0,))
+    def burnin_state(self, params=()):
+        """
+        Calculates the C14 content of all the boxes within a CBM at the end of the burn-in period. Uses the
+        precomputed solar cycle response from compile_burnin when the spike of the production rate model starts
+        after the burn-in period, and integrates the burn-in period otherwise.
+        Parameters
+        ----------
+        params : ndarray, optional
+            Parameters for the production rate model
+        Returns
+        -------
+        ndarray
+            Value of each box in the CBM at the end of the burn-in period
+        """
+        run_burnin = lambda: self.run_burnin(y0=self.steady_state_y0, params=params)[-1, :]
+        if self.burnin_basis is None:
+            return run_burnin()
+
+        start, duration = params[self.start_time_index], 10**params[self.start_time_index+1]
+        if self.amplitude_index is None:
+            amplitude = self.solar_amplitude
+        else:
+            amplitude = 10**params[self.amplitude_index] * self.steady_state_production
+        phase = params[self.phase_index] * _SOLAR_FREQUENCY
+        cached = self.steady_state_y0 + amplitude * (jnp.cos(phase) * self.burnin_basis[0] +
+                                                     jnp.sin(phase) * self.burnin_basis[1])
+        # the super gaussian vanishes to machine precision half a duration before its start time
+        return cond(start - duration / 2. >= self.burn_in_time[-1], lambda: cached, run_burnin)
+
+    @partial(jit, static_argnums=(0,))
+    def production_batch(self, tval, params):
+        """
+        Evaluates the production rate model for a batch of parameters in a single call.
+        Parameters
+        ----------
+        tval : ndarray
+            Output time sampling
+        params : ndarray
+            Parameters for the production rate model, one set of parameters per row
+        Returns
+        -------
+        ndarray
+            Production rates on tval, one row per set of parameters
+        """
+        return vmap(lambda p: self.production(tval, p))(params)
+
     # def NestedSampler(self, params, likelihood, low_bound=None, high_bound=None, sampler_name='multi_ellipsoid'):
     #     """
     #     Runs Nested Sampling sampler on the parameter space of some model, subject to some likelihood function.
@@ -193,13 +465,11 @@ class CarbonFitter:
         else:
             color_min, color_max = (np.min(array), np.max(array))
 
-        def value_to_color(val):
-            val_position = (val - color_min) / (color_max - color_min)
-            ind = int(val_position * (n_colors - 1))
-            return palette[ind]
+        val_position = (arr - color_min) / (color_max - color_min)
+        colors = np.asarray(palette)[(val_position * (n_colors - 1)).astype(int)]
 
         ax.scatter(
-            x=x, y=y, s=size * square_size, c=[value_to_color(i) for i in arr], marker='s')
+            x=x, y=y, s=size * square_size, c=colors, marker='s')
         ax.set_xticks(np.unique(x))
         ax.set_yticks(np.unique(x))
 
@@ -313,8 +583,8 @@ class CarbonFitter:
             ax1.set_ylabel(r"$\Delta^{14}$C (‰)")
             fig.subplots_adjust(hspace=0.05)
 
-            for param in chain[idx][:size2]:
-                ax2.plot(sf.time_data_fine, sf.production(sf.time_data_fine, *param), alpha=alpha2, color=colors[i])
+            ax2.plot(sf.time_data_fine, sf.production_batch(sf.time_data_fine, chain[idx][:size2]).T, alpha=alpha2,
+                     color=colors[i])
 
         ax1.errorbar(sf.time_data, sf.d14c_data, yerr=sf.d14c_data_error, fmt="ok", capsize=3,
                      markersize=6.5, elinewidth=3, label=r"average $\Delta^{14}$C")
@@ -372,8 +642,8 @@ class SingleFitter(CarbonFitter):
                     cbm = ticktack.load_presaved_model(cbm, production_rate_units=production_rate_units)
                 else:
                     cbm = ticktack.load_model(cbm, production_rate_units=production_rate_units)
-            except:
-                raise ValueError('Must be a valid CBM model')
+            except (OSError, KeyError) as e:
+                raise ValueError('Must be a valid CBM model') from e
         self.cbm = cbm
         self.cbm.compile()
         self.box = box
@@ -401,10 +671,15 @@ class SingleFitter(CarbonFitter):
             self.box_idx = 1
 
         self.steady_state_box = self.steady_state_y0[self.box_idx]
+        self.solar_amplitude = 0.18 * self.steady_state_production
         self.adaptive = adaptive
+        self.burnin_basis = None
+        self.phase_index = None
+        self.amplitude_index = None
+        self.dtype = jnp.float64
 
     def load_data(self, file_name, oversample=1008, burnin_oversample=1, burnin_time=2000, num_offset=4,
-        verbose=False):
+        verbose=False, dtype=None):
         """
         Loads d14c data from a csv file.
         Parameters
@@ -419,28 +694,40 @@ class SingleFitter(CarbonFitter):
             Number of years in the burn-in period. 2000 by default
         num_offset : int, optional
             Number of data points used for normalization. 4 by default
-        """
+        dtype : dtype, optional
+            Floating point precision of the data used in the likelihood, e.g. jnp.float32 for faster MCMC
+            exploration. The carbon box model is always integrated in float64, and the offset normalizing the
+            modelled d14c is kept in float64 too. Keeps the current precision (float64 by default) if None
+        """
+        self.clear_jit_caches()
+        if dtype is not None:
+            self.dtype = dtype
         data = Table.read(file_name, format="ascii")
         self.time_data = jnp.array(data["year"])
-        self.d14c_data = jnp.array(data["d14c"])
-        self.d14c_data_error = jnp.array(data["sig_d14c"])
+        self.d14c_data = jnp.array(data["d14c"], dtype=self.dtype)
+        self.d14c_data_error = jnp.array(data["sig_d14c"], dtype=self.dtype)
+        self.d14c_data_inv_error = 1. / self.d14c_data_error
         self.start = np.nanmin(self.time_data)
         self.end = np.nanmax(self.time_data)
         self.burn_in_time = jnp.arange(self.start - burnin_time, self.start + 1, 1.)
         self.oversample = oversample
         self.burnin_oversample = burnin_oversample
-        self.offset = jnp.mean(self.d14c_data[:num_offset])
+        self.offset = jnp.mean(jnp.array(data["d14c"][:num_offset]))
         self.annual = jnp.arange(self.start, self.end + 1)
-        self.mask = jnp.isin(self.annual, self.time_data)
+        self.data_index = jnp.searchsorted(self.annual, self.time_data)
         self.time_data_fine = jnp.linspace(jnp.min(self.annual), jnp.max(self.annual) + 2,
                                            (self.annual.size + 1) * self.oversample)
-        try:
+        # the cached solar cycle response depends on the burn-in period, so rebuild it for the new data
+        self.burnin_basis = None
+        if self.adaptive and self.phase_index is not None:
+            self.compile_burnin()
+        if "growth_season" in data.colnames:
             self.growth = self.get_growth_vector(data["growth_season"][0])
             if verbose:
                 with open('data_log.txt', 'a') as f:
                     f.write(" Custom Growth Season")
                     f.write("\n")
-        except:
+        else:
             if self.hemisphere == 'north':
                 self.growth = self.get_growth_vector("april-september")
                 if verbose:
@@ -507,14 +794,19 @@ class SingleFitter(CarbonFitter):
             "flexible_sinusoid_affine_variant", "control_points", "inverse_solver"
         """
         self.production = None
+        self.clear_jit_caches()
+        self.burnin_basis = None
+        self.phase_index = None
+        self.amplitude_index = None
         if callable(model):
-            self.production = model
+            self.production = lambda t, params: model(t, *params)
             self.production_model = 'custom'
             self.start_time_index = None
         elif model == "simple_sinusoid":
             self.production = self.simple_sinusoid
             self.production_model = 'simple sinusoid'
             self.start_time_index = 0
+            self.phase_index = 2
         elif model == "spike_only":
             self.production = self.spike_only
             self.production_model = 'spike only'
@@ -528,10 +820,14 @@ class SingleFitter(CarbonFitter):
             self.production = self.flexible_sinusoid
             self.production_model = 'flexible sinusoid'
             self.start_time_index = 0
+            self.phase_index = 2
+            self.amplitude_index = 4
         elif model == "flexible_sinusoid_affine_variant":
             self.production = self.flexible_sinusoid_affine_variant
             self.production_model = 'flexible sinusoid affine variant'
             self.start_time_index = 1
+            self.phase_index = 3
+            self.amplitude_index = 5
         # elif model == "affine":
         #     self.production = self.affine
         #     self.production_model = 'affine'
@@ -540,6 +836,7 @@ class SingleFitter(CarbonFitter):
             self.control_points_time_fine = jnp.linspace(self.start, self.end,
                                                          int((self.end - self.start) * self.oversample))
             self.production = self.interp_gp
+            self.compile_gp()
             self.production_model = 'control points'
             self.start_time_index = None
         elif model == "inverse_solver":
@@ -550,37 +847,38 @@ class SingleFitter(CarbonFitter):
             raise ValueError(
                 "model is not a callable, or does not take value from: simple_sinusoid, flexible_sinusoid, "
                 "flexible_sinusoid_affine_variant, inverse_solver, control_points")
+        # a new function on every compile, as the carbon box model keys its compiled code on the production rate model
+        self.production = partial(self.production)
+        if self.adaptive and self.phase_index is not None:
+            self.compile_burnin()
 
     @partial(jit, static_argnums=(0,))
-    def interp_gp(self, tval, *args):
+    def interp_gp(self, tval, params):
         """
         A Gaussian Process regression interpolator.
         Parameters
         ----------
         tval : ndarray
             Output time sampling
-        args : ndarray | float
-            Set of annually resolved control-points passed in as a ndarray
+        params : ndarray
+            Set of annually resolved control-points
         Returns
         -------
         ndarray
             Interpolation on tval
         """
         tval = tval.reshape(-1)
-        params = jnp.array(list(args)).reshape(-1)
-        kernel = kernels.Matern32(1)
-        gp = GaussianProcess(kernel, self.control_points_time, mean=params[0])
-        params = jnp.array(list(args)).reshape(-1)
-        return gp.condition(params, tval)[1].loc
+        params = jnp.asarray(params).reshape(-1)
+        return params[0] + _GP_KERNEL(tval, self.control_points_time) @ (self.gp_weights @ (params - params[0]))
 
-    def interp_IS(self, tval, *args):
+    def interp_IS(self, tval, params):
         """
         A linear interpolator for inverse solver.
         Parameters
         ----------
         tval : ndarray
             Output time sampling
-        args : ndarray | float
+        params : ndarray
             Set of production rates on the same time sampling as self.time_data
         Returns
         -------
@@ -588,8 +886,7 @@ class SingleFitter(CarbonFitter):
             Interpolation on tval
         """
         tval = tval.reshape(-1)
-        y = jnp.array(list(args)).reshape(-1)
-        return jnp.interp(tval, self.time_data, y)
+        return jnp.interp(tval, self.time_data, jnp.asarray(params).reshape(-1))
 
     @partial(jit, static_argnums=(0,))
     def super_gaussian(self, t, start_time, duration, area):
@@ -613,10 +910,10 @@ class SingleFitter(CarbonFitter):
         """
         middle = start_time + duration / 2.
         height = area / duration
-        return height * jnp.exp(- ((t - middle) / (1. / 1.93516 * duration)) ** 16.)
+        return height * jnp.exp(- ((t - middle) / (_SUPER_GAUSSIAN_WIDTH * duration)) ** 16.)
 
     @partial(jit, static_argnums=(0,))
-    def simple_sinusoid(self, t, *args):
+    def simple_sinusoid(self, t, params):
         """
         A simple sinusoid production rate model. Tunable parameters are,
         Start time: start time\n
@@ -627,23 +924,23 @@ class SingleFitter(CarbonFitter):
         ----------
         t : ndarray
             Time sampling
-        args : ndarray
+        params : ndarray
             Tunable parameters. Must include, start time, duration, phase and area
         Returns
         -------
         ndarray
             Production rate on t
         """
-        start_time, log_duration, phase, log_area = jnp.array(list(args)).reshape(-1)
+        start_time, log_duration, phase, log_area = params
         duration, area = 10**log_duration, 10**log_area
         height = self.super_gaussian(t, start_time, duration, area)
-        production = self.steady_state_production + 0.18 * self.steady_state_production * jnp.sin(
-            2 * np.pi / 11 * t + phase * 2 * np.pi / 11) + height
+        production = self.steady_state_production + self.solar_amplitude * jnp.sin(
+            _SOLAR_FREQUENCY * (t + phase)) + height
         return production
 
 
     @partial(jit, static_argnums=(0,))
-    def spike_only(self, t, *args):
+    def spike_only(self, t, params):
         """
         A simple sinusoid production rate model. Tunable parameters are,
         Start time: start time\n
@@ -653,21 +950,21 @@ class SingleFitter(CarbonFitter):
         ----------
         t : ndarray
             Time sampling
-        args : ndarray
+        params : ndarray
             Tunable parameters. Must include, start time, duration, phase and area
         Returns
         -------
         ndarray
             Production rate on t
         """
-        start_time, log_duration, log_area = jnp.array(list(args)).reshape(-1)
+        start_time, log_duration, log_area = params
         duration, area = 10**log_duration, 10**log_area
         height = self.super_gaussian(t, start_time, duration, area)
         production = self.steady_state_production + height
         return production
 
     @partial(jit, static_argnums=(0,))
-    def flexible_sinusoid(self, t, *args):
+    def flexible_sinusoid(self, t, params):
         """
         A flexible sinusoid production rate model. Tunable parameters are,
         Start time: start time\n
@@ -679,25 +976,25 @@ class SingleFitter(CarbonFitter):
         ----------
         t : ndarray
             Time sampling
-        args : ndarray
+        params : ndarray
             Tunable parameters. Must include, start time, duration, phase, area and amplitude
         Returns
         -------
         ndarray
             Production rate on t
         """
-        start_time, log_duration, phase, log_area, log_amplitude = jnp.array(list(args)).reshape(-1)
+        start_time, log_duration, phase, log_area, log_amplitude = params
         duration, area, amplitude = 10**log_duration, 10**log_area, 10**log_amplitude
 
         height = self.super_gaussian(t, start_time, duration, area)
         production = self.steady_state_production + amplitude * self.steady_state_production * jnp.sin(
-            2 * np.pi / 11 * t + phase * 2 * np.pi / 11) + height
+            _SOLAR_FREQUENCY * (t + phase)) + height
         return production
 
 
 
     @partial(jit, static_argnums=(0,))
-    def flexible_sinusoid_affine_variant(self, t, *args):
+    def flexible_sinusoid_affine_variant(self, t, params):
         """
         A flexible sinusoid production rate model with a linear gradient. Tunable parameters are,
         Gradient: linear gradient\n
@@ -710,21 +1007,20 @@ class SingleFitter(CarbonFitter):
         ----------
         t : ndarray
             Time sampling
-        args : ndarray
+        params : ndarray
             Tunable parameters. Must include, gradient, start time, duration, phase, area and amplitude
         Returns
         -------
         ndarray
             Production rate on t
         """
-        gradient, start_time, log_duration, phase, log_area, log_amplitude = jnp.array(list(args)).reshape(-1)
+        gradient, start_time, log_duration, phase, log_area, log_amplitude = params
         duration, area, amplitude = 10**log_duration, 10**log_area, 10**log_amplitude
         
         height = self.super_gaussian(t, start_time, duration, area)
         production = self.steady_state_production + gradient * (
                 t - self.start) * (t >= self.start) + amplitude * self.steady_state_production * jnp.sin(
-            2 * np.pi / 11 * t
-            + phase * 2 * np.pi / 11) + height
+            _SOLAR_FREQUENCY * (t + phase)) + height
         return production
 
 
@@ -750,8 +1046,8 @@ class SingleFitter(CarbonFitter):
         ndarray
             Value of each box in the CBM during the burn-in period
         """
-        box_values, _ = self.cbm.run(self.burn_in_time, self.production, y0=y0, args=params,
-                                     steady_state_production=self.steady_state_production)
+        box_values, _ = self.cbm.run_rk4(self.burn_in_time, self.production, y0=y0, args=(params,),
+                                         steady_state_production=self.steady_state_production)
         return box_values
 
     @partial(jit, static_argnums=(0))
@@ -775,9 +1071,7 @@ class SingleFitter(CarbonFitter):
             step_ts = jnp.linspace(start,start+duration,25)
         else:
             step_ts = None
-        time_values = jnp.linspace(jnp.min(self.annual), jnp.max(self.annual) + 2,
-                                   (self.annual.size + 1) * self.oversample)
-        box_values, _ = self.cbm.run(time_values, self.production, y0=y0, args=params,
+        box_values, _ = self.cbm.run(self.time_data_fine, self.production, y0=y0, args=(params,),
                                      steady_state_production=self.steady_state_production,
                                      adaptive=self.adaptive,step_ts=step_ts)
         return box_values
@@ -796,16 +1090,15 @@ class SingleFitter(CarbonFitter):
             Predicted d14c value
         """
         if self.adaptive:
-            burnin = self.run_burnin(y0=self.steady_state_y0, params=params)
-            y0 = burnin[-1, :]
+            y0 = self.burnin_state(params=params)
         else:
             y0 = self.steady_state_y0
 
         event = self.run_event(y0=y0, params=params)
 
         binned_data = self.cbm.bin_data(event[:, self.box_idx], self.oversample, self.annual, growth=self.growth)
-        d14c = (binned_data - self.steady_state_y0[self.box_idx]) / self.steady_state_y0[self.box_idx] * 1000
-        return d14c[self.mask] + self.offset
+        d14c = (binned_data - self.steady_state_box) / self.steady_state_box * 1000
+        return jnp.take(d14c, self.data_index) + self.offset
 
     @partial(jit, static_argnums=(0,))
     def dc14_fine(self, params=()):
@@ -821,15 +1114,44 @@ class SingleFitter(CarbonFitter):
             Predicted d14c value
         """
         if self.adaptive:
-            burnin = self.run_burnin(y0=self.steady_state_y0, params=params)
-            y0 = burnin[-1, :]
+            y0 = self.burnin_state(params=params)
         else:
             y0 = self.steady_state_y0
 
         event = self.run_event(y0=y0, params=params)
-        d14c = (event[:, self.box_idx] - self.steady_state_y0[self.box_idx]) / self.steady_state_y0[self.box_idx] * 1000
+        d14c = (event[:, self.box_idx] - self.steady_state_box) / self.steady_state_box * 1000
         return d14c + self.offset
 
+    @partial(jit, static_argnums=(0,))
+    def dc14_batch(self, params):
+        """
+        Predict d14c on the time sampling from the data file for a batch of parameters in a single call.
+        Parameters
+        ----------
+        params : ndarray
+            Parameters for the production rate model, one set of parameters per row
+        Returns
+        -------
+        ndarray
+            Predicted d14c values, one row per set of parameters
+        """
+        return self.batched(self.dc14)(params)
+
+    @partial(jit, static_argnums=(0,))
+    def dc14_fine_batch(self, params):
+        """
+        Predict d14c on a sub-annual time sampling for a batch of parameters in a single call.
+        Parameters
+        ----------
+        params : ndarray
+            Parameters for the production rate model, one set of parameters per row
+        Returns
+        -------
+        ndarray
+            Predicted d14c values, one row per set of parameters
+        """
+        return self.batched(self.dc14_fine)(params)
+
     # @partial(jit, static_argnums=(0,))
     def log_likelihood(self, params=()):
         """
@@ -843,8 +1165,23 @@ class SingleFitter(CarbonFitter):
         float
             Gaussian log-likelihood
         """
-        d14c = self.dc14(params)
-        return -0.5 * jnp.sum(((self.d14c_data - d14c) / self.d14c_data_error) ** 2)
+        return -0.5 * self._chi2(self.dc14(params))
+
+    @partial(jit, static_argnums=(0,))
+    def _chi2(self, d14c):
+        """
+        Computes the chi-squared misfit of predicted d14c against the data, as a single weighted reduction.
+        Parameters
+        ----------
+        d14c : ndarray
+            Predicted d14c on the time sampling from the data file
+        Returns
+        -------
+        float
+            Chi-squared misfit
+        """
+        residual = (d14c.astype(self.dtype) - self.d14c_data) * self.d14c_data_inv_error
+        return jnp.dot(residual, residual)
 
     @partial(jit, static_argnums=(0,))
     def log_joint_likelihood(self, params, low_bounds, up_bounds):
@@ -863,8 +1200,7 @@ class SingleFitter(CarbonFitter):
         float
             Log joint likelihood
         """
-        lp = 0
-        lp += jnp.any((params < low_bounds) | (params > up_bounds)) * -jnp.inf
+        lp = self.log_prior(params, low_bounds, up_bounds)
         pos = self.log_likelihood(params)
         return lp + pos
 
@@ -883,9 +1219,9 @@ class SingleFitter(CarbonFitter):
         float
             Gaussian Process log-likelihood
         """
-        kernel = kernels.Matern32(1)
-        gp = GaussianProcess(kernel, self.control_points_time, mean=params[0])
-        return gp.log_probability(params)
+        r = params - params[0]
+        alpha = cho_solve((self.gp_cholesky, True), r)
+        return -0.5 * (r @ alpha + r.size * jnp.log(2 * jnp.pi)) - jnp.sum(jnp.log(jnp.diag(self.gp_cholesky)))
 
     @partial(jit, static_argnums=(0,))
     def log_joint_likelihood_gp(self, params, low_bounds, up_bounds):
@@ -900,7 +1236,7 @@ class SingleFitter(CarbonFitter):
         float
             Log joint likelihood
         """
-        lp = jnp.any((params < low_bounds) | (params > up_bounds)) * -jnp.inf
+        lp = self.log_prior(params, low_bounds, up_bounds)
         return self.log_likelihood(params=params) + self.log_likelihood_gp(params) + lp
 
     @partial(jit, static_argnums=(0,))
@@ -934,13 +1270,16 @@ class SingleFitter(CarbonFitter):
         """
         return grad(self.neg_log_joint_likelihood_gp)(params)
 
-    def fit_ControlPoints(self, low_bound=0):
+    def fit_ControlPoints(self, low_bound=0, use_gradient=True):
         """
         Fits control-points by minimizing the negative log joint likelihood.
         Parameters
         ----------
         low_bound : int, optional
             The minimum value each control-point can take. 0 by default.
+        use_gradient : bool, optional
+            If True, the objective and its gradient are computed together by automatic differentiation. Else, the
+            gradient is estimated by finite differences. True by default.
         Returns
         -------
         OptimizeResult
@@ -948,7 +1287,11 @@ class SingleFitter(CarbonFitter):
         """
         initial = self.steady_state_production * jnp.ones((len(self.control_points_time),))
         bounds = tuple([(low_bound, None)] * len(initial))
-        soln = scipy.optimize.minimize(self.neg_log_joint_likelihood_gp, initial, bounds=bounds,
+        if use_gradient:
+            objective = jit(value_and_grad(self.neg_log_joint_likelihood_gp))
+        else:
+            objective = self.neg_log_joint_likelihood_gp
+        soln = scipy.optimize.minimize(objective, initial, jac=use_gradient, bounds=bounds,
                                        options={'maxiter': 100000, 'maxfun': 100000, })
         return soln
 
@@ -961,7 +1304,6 @@ class SingleFitter(CarbonFitter):
             new_rate = production_rate
         return new_rate
 
-    @partial(jit, static_argnums=(0, 5, 6))
     def reconstruct_production_rate(self, d14c, t_in, t_out, steady_state_solution, steady_state_production=None,
                                     target_C_14=None):
         """
@@ -976,7 +1318,16 @@ class SingleFitter(CarbonFitter):
         Returns
         -------
         """
+        if target_C_14 is not None:
+            steady_state = self.cbm.equilibrate(production_rate=self.cbm.equilibrate(target_C_14=target_C_14))
+        elif steady_state_production is not None:
+            steady_state = self.cbm.equilibrate(production_rate=steady_state_production)
+        else:
+            raise ValueError("Must give either target C-14 or production rate.")
+        return self._reconstruct_production_rate(d14c, t_in, t_out, steady_state_solution, steady_state)
 
+    @partial(jit, static_argnums=(0,))
+    def _reconstruct_production_rate(self, d14c, t_in, t_out, steady_state_solution, steady_state):
         data = d14c / 1000 * steady_state_solution[self.box_idx] + steady_state_solution[self.box_idx]
         first1 = jnp.where(self.growth == 1, size=1)[0][0]
         first0 = jnp.where(self.growth == 0, size=1)[0][0]
@@ -999,13 +1350,6 @@ class SingleFitter(CarbonFitter):
             production_term = prod_coeff * production_rate
             return ans + production_term
 
-        if target_C_14 is not None:
-            steady_state = self.cbm.equilibrate(production_rate=self.cbm.equilibrate(target_C_14=target_C_14))
-        elif steady_state_production is not None:
-            steady_state = self.cbm.equilibrate(production_rate=steady_state_production)
-        else:
-            raise ValueError("Must give either target C-14 or production rate.")
-
         term = diffrax.ODETerm(derivative)
         solver = diffrax.Dopri5()
         saveat = diffrax.SaveAt(ts=t_out)
@@ -1077,11 +1421,13 @@ class MultiFitter(CarbonFitter):
         self.burn_in_time = None
         self.steady_state_y0 = None
         self.steady_state_production = None
+        self.solar_amplitude = None
         self.growth = None
         self.cbm = None
         self.cbm_model = None
         self.box_idx = None
         self.adaptive=adaptive
+        self.burnin_basis = None
 
     def add_SingleFitter(self, sf):
         """
@@ -1105,6 +1451,8 @@ class MultiFitter(CarbonFitter):
             self.production = sf.production
             self.production_model = sf.production_model
             self.start_time_index = sf.start_time_index
+            self.phase_index = sf.phase_index
+            self.amplitude_index = sf.amplitude_index
         elif self.production_model is not sf.production_model:
             raise ValueError(
                 "production for SingleFitters must be consistent. Got {}, expected {}".format(sf.production_model,
@@ -1123,6 +1471,7 @@ class MultiFitter(CarbonFitter):
         if self.steady_state_y0 is None:
             self.steady_state_y0 = sf.steady_state_y0
             self.steady_state_production = sf.steady_state_production
+            self.solar_amplitude = sf.solar_amplitude
         elif not jnp.allclose(self.steady_state_y0, sf.steady_state_y0):
             raise ValueError(
                 "steady state burn-in solution for SingleFitters must be consistent. Got {}, expected {}".format(
@@ -1142,6 +1491,7 @@ class MultiFitter(CarbonFitter):
         """
         Prepares a Multifitter object for d14c computation and likelihood evaluation.
         """
+        self.clear_jit_caches()
         if self.production_model == 'flexible sinusoid affine variant':
             self.production = self.flexible_sinusoid_affine_variant
         self.burn_in_time = jnp.arange(self.start - 2000, self.start + 1, 1.)
@@ -1149,21 +1499,24 @@ class MultiFitter(CarbonFitter):
         self.time_data_fine = jnp.linspace(jnp.min(self.annual), jnp.max(self.annual) + 2,
                                            (self.annual.size + 1) * self.oversample)
         for sf in self.MultiFitter:
-            sf.multi_mask = jnp.isin(self.annual, sf.time_data)
+            sf.multi_index = jnp.searchsorted(self.annual, sf.time_data)
         if self.production_model == 'control points':
             self.control_points_time = jnp.arange(self.start, self.end)
             self.production = self.multi_interp_gp
+            self.compile_gp()
+        if self.adaptive and self.phase_index is not None:
+            self.compile_burnin()
         self.steady_state_box = self.steady_state_y0[self.box_idx]
 
     @partial(jit, static_argnums=(0,))
-    def multi_interp_gp(self, tval, *args):
+    def multi_interp_gp(self, tval, params):
         """
         A Gaussian Process regression interpolator for MultiFitter.
         Parameters
         ----------
         tval : ndarray
             Output time sampling
-        args : ndarray | float
+        params : ndarray
             Set of annually resolved control-points
         Returns
         -------
@@ -1171,11 +1524,8 @@ class MultiFitter(CarbonFitter):
             Interpolated values on tval
         """
         tval = tval.reshape(-1)
-        params = jnp.array(list(args)).reshape(-1)
-        kernel = kernels.Matern32(1)
-        gp = GaussianProcess(kernel, self.control_points_time, mean=params[0])
-        params = jnp.array(list(args)).reshape(-1)
-        return gp.condition(params, tval)[1].loc
+        params = jnp.asarray(params).reshape(-1)
+        return params[0] + _GP_KERNEL(tval, self.control_points_time) @ (self.gp_weights @ (params - params[0]))
 
     @partial(jit, static_argnums=(0,))
     def super_gaussian(self, t, start_time, duration, area):
@@ -1199,10 +1549,10 @@ class MultiFitter(CarbonFitter):
         """
         middle = start_time + duration / 2.
         height = area / duration
-        return height * jnp.exp(- ((t - middle) / (1. / 1.93516 * duration)) ** 16.)
+        return height * jnp.exp(- ((t - middle) / (_SUPER_GAUSSIAN_WIDTH * duration)) ** 16.)
 
     @partial(jit, static_argnums=(0,))
-    def flexible_sinusoid_affine_variant(self, t, *args):
+    def flexible_sinusoid_affine_variant(self, t, params):
         """
         A flexible sinusoid production rate model with a linear gradient. Tunable parameters are,
         Gradient: linear gradient\n
@@ -1215,21 +1565,20 @@ class MultiFitter(CarbonFitter):
         ----------
         t : ndarray
             Time sampling
-        args : ndarray
+        params : ndarray
             Tunable parameters. Must include, gradient, start time, duration, phase, area and amplitude
         Returns
         -------
         ndarray
             Production rate on t
         """
-        gradient, start_time, log_duration, phase, log_area, log_amplitude = jnp.array(list(args)).reshape(-1)
+        gradient, start_time, log_duration, phase, log_area, log_amplitude = params
         duration, area, amplitude = 10**log_duration, 10**log_area, 10**log_amplitude
 
         height = self.super_gaussian(t, start_time, duration, area)
         production = self.steady_state_production + gradient * (
                 t - self.start) * (t >= self.start) + amplitude * self.steady_state_production * jnp.sin(
-            2 * np.pi / 11 * t
-            + phase * 2 * np.pi / 11) + height
+            _SOLAR_FREQUENCY * (t + phase)) + height
         return production
 
     @partial(jit, static_argnums=(0))
@@ -1247,8 +1596,8 @@ class MultiFitter(CarbonFitter):
         ndarray
             Value of each box in the CBM during the burn-in period
         """
-        box_values, _ = self.cbm.run(self.burn_in_time, self.production, y0=y0, args=params,
-                                     steady_state_production=self.steady_state_production)
+        box_values, _ = self.cbm.run_rk4(self.burn_in_time, self.production, y0=y0, args=(params,),
+                                         steady_state_production=self.steady_state_production)
         return box_values
 
     @partial(jit, static_argnums=(0))
@@ -1272,9 +1621,7 @@ class MultiFitter(CarbonFitter):
             step_ts = jnp.linspace(start,start+duration,25)
         else:
             step_ts = None
-        time_values = jnp.linspace(jnp.min(self.annual), jnp.max(self.annual) + 2,
-                                   (self.annual.size + 1) * self.oversample)
-        box_values, _ = self.cbm.run(time_values, self.production, y0=y0, args=params,
+        box_values, _ = self.cbm.run(self.time_data_fine, self.production, y0=y0, args=(params,),
                                      steady_state_production=self.steady_state_production,
                                      adaptive=self.adaptive)
         return box_values
@@ -1293,14 +1640,28 @@ class MultiFitter(CarbonFitter):
                    Predicted d14c value
                """
         if self.adaptive:
-            burnin = self.run_burnin(y0=self.steady_state_y0, params=params)
-            y0 = burnin[-1, :]
+            y0 = self.burnin_state(params=params)
         else:
             y0 = self.steady_state_y0
         event = self.run_event(y0=y0, params=params)
-        d14c = (event[:, self.box_idx] - self.steady_state_y0[self.box_idx]) / self.steady_state_y0[self.box_idx] * 1000
+        d14c = (event[:, self.box_idx] - self.steady_state_box) / self.steady_state_box * 1000
         return d14c
 
+    @partial(jit, static_argnums=(0,))
+    def dc14_fine_batch(self, params):
+        """
+        Predict d14c on a sub-annual time sampling for a batch of parameters in a single call.
+        Parameters
+        ----------
+        params : ndarray
+            Parameters for the production rate model, one set of parameters per row
+        Returns
+        -------
+        ndarray
+            Predicted d14c values, one row per set of parameters
+        """
+        return self.batched(self.dc14_fine)(params)
+
     # @partial(jit, static_argnums=(0,))
     def multi_likelihood(self, params):
         """
@@ -1315,8 +1676,7 @@ class MultiFitter(CarbonFitter):
             Log-likelihood
         """
         if self.adaptive:
-            burnin = self.run_burnin(y0=self.steady_state_y0, params=params) # steady_state_y0 is hem independent
-            y0 = burnin[-1, :]
+            y0 = self.burnin_state(params=params) # steady_state_y0 is hem independent
         else:
             y0 = self.steady_state_y0
 
@@ -1326,8 +1686,8 @@ class MultiFitter(CarbonFitter):
             event = event_mat[:, sf.box_idx] # chooses the right box using the information from sf
             binned_data = sf.cbm.bin_data(event, self.oversample, self.annual, growth=sf.growth) # bins using sf.cbm
             d14c = (binned_data - sf.steady_state_box) / sf.steady_state_box * 1000 # steady_state_box is hem dependent
-            d14c_sf = d14c[sf.multi_mask] + sf.offset
-            like += jnp.sum(((sf.d14c_data - d14c_sf) / sf.d14c_data_error) ** 2) * -0.5
+            d14c_sf = jnp.take(d14c, sf.multi_index) + sf.offset
+            like += sf._chi2(d14c_sf) * -0.5
         return like
 
     @partial(jit, static_argnums=(0,))
@@ -1344,9 +1704,9 @@ class MultiFitter(CarbonFitter):
         float
             Gaussian Process log-likelihood
         """
-        kernel = kernels.Matern32(1)
-        gp = GaussianProcess(kernel, self.control_points_time, mean=params[0])
-        return gp.log_probability(params)
+        r = params - params[0]
+        alpha = cho_solve((self.gp_cholesky, True), r)
+        return -0.5 * (r @ alpha + r.size * jnp.log(2 * jnp.pi)) - jnp.sum(jnp.log(jnp.diag(self.gp_cholesky)))
 
     def log_joint_likelihood(self, params, low_bounds, up_bounds):
         """
@@ -1364,8 +1724,7 @@ class MultiFitter(CarbonFitter):
         float
             Log joint likelihood
         """
-        lp = 0
-        lp += jnp.any((params < low_bounds) | (params > up_bounds)) * -jnp.inf
+        lp = self.log_prior(params, low_bounds, up_bounds)
         pos = self.multi_likelihood(params)
         return lp + pos
 
@@ -1382,7 +1741,7 @@ class MultiFitter(CarbonFitter):
         float
             Log joint likelihood
         """
-        lp = jnp.any((params < low_bounds) | (params > up_bounds)) * -jnp.inf
+        lp = self.log_prior(params, low_bounds, up_bounds)
         return self.multi_likelihood(params=params) + self.log_likelihood_gp(params) + lp
 
     def neg_log_joint_likelihood_gp(self, params):
@@ -1400,13 +1759,16 @@ class MultiFitter(CarbonFitter):
         """
         return -1 * self.multi_likelihood(params=params) + -1 * self.log_likelihood_gp(params)
 
-    def fit_ControlPoints(self, low_bound=0):
+    def fit_ControlPoints(self, low_bound=0, use_gradient=True):
         """
         Fits the control-points by minimizing the negative log joint likelihood.
         Parameters
         ----------
         low_bound : int, optional
             The minimum value each control-point can take. 0 by default.
+        use_gradient : bool, optional
+            If True, the objective and its gradient are computed together by automatic differentiation. Else, the
+            gradient is estimated by finite differences. True by default.
         Returns
         -------
         OptimizeResult
@@ -1414,7 +1776,11 @@ class MultiFitter(CarbonFitter):
         """
         initial = self.steady_state_production * jnp.ones((len(self.control_points_time),))
         bounds = tuple([(low_bound, None)] * len(initial))
-        soln = scipy.optimize.minimize(self.neg_log_joint_likelihood_gp, initial, bounds=bounds,
+        if use_gradient:
+            objective = jit(value_and_grad(self.neg_log_joint_likelihood_gp))
+        else:
+            objective = self.neg_log_joint_likelihood_gp
+        soln = scipy.optimize.minimize(objective, initial, jac=use_gradient, bounds=bounds,
                                        options={'maxiter': 100000, 'maxfun': 100000, })
         return soln.x
 
@@ -1636,11 +2002,10 @@ def plot_samples(average_path=None, chains_path=None, cbm_models=None, cbm_label
             time_data_fine = sf.time_data_fine
 
         idx = np.random.randint(len(chain), size=size)
-        for param in chain[idx]:
-            ax1.plot(time_data_fine, sf.dc14_fine(params=param), alpha=alpha, color=colors[i])
+        ax1.plot(time_data_fine, sf.dc14_fine_batch(chain[idx]).T, alpha=alpha, color=colors[i])
 
-        for param in chain[idx][:size2]:
-            ax2.plot(time_data_fine, sf.production(sf.time_data_fine, *param), alpha=alpha2, color=colors[i])
+        ax2.plot(time_data_fine, sf.production_batch(sf.time_data_fine, chain[idx][:size2]).T, alpha=alpha2,
+                 color=colors[i])
 
     ax1.errorbar(time_data, sf.d14c_data, yerr=sf.d14c_data_error, fmt="ok", capsize=capsize, markersize=markersize,
                  elinewidth=elinewidth, label=r"average $\Delta^{14}$C")
@@ -1739,14 +2104,12 @@ def plot_ControlPoints(average_path=None, soln_path=None, chain_path=None, cbm_m
                 ax1.plot(time_data_fine, sf.dc14_fine(mu), color=colors[i])
             else:
                 idx = np.random.randint(len(chain), size=size)
-                for param in chain[idx]:
-                    ax1.plot(time_data_fine, sf.dc14_fine(params=param), alpha=alpha, color=colors[i])
+                ax1.plot(time_data_fine, sf.dc14_fine_batch(chain[idx]).T, alpha=alpha, color=colors[i])
 
             ax2.plot(control_points_time_fine, sf.interp_gp(sf.control_points_time_fine, mu), color=colors[i])
             idx = np.random.randint(len(chain), size=30)
-            for param in chain[idx]:
-                ax2.plot(control_points_time_fine, sf.interp_gp(sf.control_points_time_fine, param),
-                         alpha=0.2, color=colors[i])
+            ax2.plot(control_points_time_fine, sf.production_batch(sf.control_points_time_fine, chain[idx]).T,
+                     alpha=0.2, color=colors[i])
         else:
             ax1.plot(time_data_fine, sf.dc14_fine(soln), color=colors[i])
             ax2.plot(control_points_time_fine, sf.interp_gp(sf.control_points_time_fine, soln), color=colors[i])
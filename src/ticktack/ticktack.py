@@ -4,7 +4,7 @@ from jax import jit
 import jax
 from functools import partial
 
-from jax.lax import cond, dynamic_update_slice, fori_loop, dynamic_slice
+from jax.lax import cond, fori_loop, dynamic_slice
 import diffrax
 
 import h5py
@@ -366,10 +366,11 @@ class CarbonBoxModel:
 
             self._reservoir_content = jnp.array(
                 [[self._nodes[j].get_reservoir_content() for j in range(self._n_nodes)]])
-            self._fluxes = jnp.zeros((self._n_nodes, self._n_nodes))
-            for flow in self._edges:
-                self._fluxes = self._fluxes.at[self._reverse_nodes[flow.get_source()], 
-                    self._reverse_nodes[flow.get_destination()]].set(flow.get_flux())
+            sources = np.array([self._reverse_nodes[flow.get_source()] for flow in self._edges], dtype=int)
+            destinations = np.array([self._reverse_nodes[flow.get_destination()] for flow in self._edges], dtype=int)
+            fluxes = np.zeros((self._n_nodes, self._n_nodes))
+            fluxes[sources, destinations] = [flow.get_flux() for flow in self._edges]
+            self._fluxes = jnp.array(fluxes)
 
             self._decay_matrix = jnp.diag(jnp.array([self._decay_constant] * self._n_nodes))
             self._production_coefficients = jnp.array([self._nodes[j].get_production() for j in range(self._n_nodes)])
@@ -380,8 +381,9 @@ class CarbonBoxModel:
             self._matrix = jnp.transpose(c_14_fluxes) - new_c_14_fluxes - self._decay_matrix
             self._non_hemisphere_model = self._nodes[0].get_hemisphere() == "None"
 
+            unbalanced = np.abs(np.sum(self._corrected_fluxes, axis=0) - np.sum(self._corrected_fluxes, axis=1)) > 0.001
             for i in range(self._n_nodes):
-                if jnp.abs(jnp.sum(self._corrected_fluxes[:, i]) - jnp.sum(self._corrected_fluxes[i, :])) > 0.001:
+                if unbalanced[i]:
                     raise ValueError('the outgoing and incoming fluxes are not balanced for ' + str(self._nodes[i]))
                 if self._non_hemisphere_model:
                     if not self._nodes[i].get_hemisphere() == "None":
@@ -529,6 +531,8 @@ class CarbonBoxModel:
         end = time_values[-1]
         step = 1 / 48 # 4 per month 
         max_steps = None #48*jnp.size(time_values)
+        # an unbounded solve needs an explicit number of checkpoints to be reverse-mode differentiable
+        adjoint = diffrax.RecursiveCheckpointAdjoint(checkpoints=100)
         
         if adaptive:
             stepsize_controller = diffrax.PIDController(rtol=5e-11, atol=5e-11,
@@ -540,10 +544,76 @@ class CarbonBoxModel:
 
         states = diffrax.diffeqsolve(term, solver, args=args, y0=y_initial-solution, t0 = start, t1 = end,
             dt0 = dt0, stepsize_controller=stepsize_controller,saveat=saveat, 
-            max_steps=max_steps)
+            max_steps=max_steps, adjoint=adjoint)
 
         return states.ys+solution, solution
 
+    @partial(jit, static_argnums=(0, 2, 5, 6))
+    def run_rk4(self, time, production, y0=None, args=(), steady_state_production=None, substeps=48):
+        """ Fixed-step counterpart of run. Integrates the same linear system of ODEs with a classical fourth order
+        Runge-Kutta scheme, taking 'substeps' equal steps between consecutive time values inside a single
+        jax.lax.scan. Avoids the step size control of run, which makes it well suited to long, smooth integrations
+        such as the burn-in period. This method will not work if the compile method has not been executed first.
+        Parameters
+        ----------
+        time : list
+            the time values at which to calculate the content of all the boxes.
+        production : callable
+            the production function which determines the contents of the boxes.
+        y0 : list, optional
+            the initial contents of all boxes. Defaults to None, in which case the steady state solution is used.
+        args : tuple, optional
+            optional arguments to pass into the production function.
+        steady_state_production : float
+            the steady state production rate with which to equilibrate with to find steady state solution.
+        substeps : int, optional
+            number of Runge-Kutta steps between consecutive time values. Defaults to 48.
+        Returns
+        -------
+        Union[list, list]
+            The value of each box in the carbon box at the specified time_values along with the steady state solution
+            for the system.
+        Raises
+        ------
+        ValueError
+            If the steady state production rate is not specified.
+            If the production is not a callable function.
+        """
+        if steady_state_production is None:
+            raise ValueError("Must give the steady state production rate.")
+        if not callable(production):
+            raise ValueError("incorrect object type for production")
+
+        def derivative(t, y):
+            ans = jnp.matmul(self._matrix, y)
+            production_rate_constant = production(t, *args) - steady_state_production
+            production_rate_constant = self._convert_production_rate(production_rate_constant)
+            return ans + self._production_coefficients * production_rate_constant
+
+        def rk4_step(t, y, dt):
+            k1 = derivative(t, y)
+            k2 = derivative(t + dt / 2, y + dt / 2 * k1)
+            k3 = derivative(t + dt / 2, y + dt / 2 * k2)
+            k4 = derivative(t + dt, y + dt * k3)
+            return y + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+        def interval(y, t_span):
+            t0, t1 = t_span
+            dt = (t1 - t0) / substeps
+            y = fori_loop(0, substeps, lambda i, y: rk4_step(t0 + i * dt, y, dt), y)
+            return y, y
+
+        time_values = jnp.array(time)
+        solution = self.equilibrate(production_rate=steady_state_production)
+        if y0 is not None:
+            y_initial = jnp.array(y0) - solution
+        else:
+            y_initial = jnp.zeros_like(solution)
+
+        _, states = jax.lax.scan(interval, y_initial, (time_values[:-1], time_values[1:]))
+        states = jnp.concatenate([y_initial[jnp.newaxis, :], states])
+        return states + solution, solution
+
     @partial(jit, static_argnums=(0, 2))
     def bin_data(self, data, time_oversample, time_out, growth):
         """ Bins the data given based on the oversample and the growth season according to Schulman's convention.
@@ -565,10 +635,14 @@ class CarbonBoxModel:
         Raises
         ------
         ValueError
-            If the data is not one-dimensional or in a single row.
+            If the data is not one-dimensional or in a single row, or does not extend a year past time_out.
         """
         if data.ndim != 1:
             raise ValueError("Data is not one-dimensional! Data must be contained in one row. ")
+        if data.shape[0] < (len(time_out) + 1) * time_oversample:
+            raise ValueError("Data must cover one year more than time_out to bin over the growth season. Expected "
+                             "at least {} samples, got {}.".format((len(time_out) + 1) * time_oversample,
+                                                                  data.shape[0]))
 
         masked = jnp.linspace(0, 1, time_oversample)
         kernel = (masked < jnp.count_nonzero(growth)/12)
@@ -587,16 +661,16 @@ class CarbonBoxModel:
     
         shifted_index = _shifted_index_finder(growth)
   
-        binned_data = self._rebin1D(time_out, shifted_index, time_oversample, kernel, data)
+        binned_data = self._rebin1D(time_out, shifted_index, kernel, data)
         return binned_data
 
-    @partial(jit, static_argnums=(0, 3))
-    def _rebin1D(self, time_out, shifted_index, oversample, kernel, s):
-        binned_data = jnp.zeros((len(time_out),))
-        fun = lambda i, val: dynamic_update_slice(val, jnp.array([jnp.sum(jnp.multiply(dynamic_slice(
-            s, (i * oversample + shifted_index * oversample // 12,), (oversample,)), kernel)) / (
-                                                                      jnp.sum(kernel))]), (i,))
-        binned_data = fori_loop(0, len(time_out), fun, binned_data)
+    @partial(jit, static_argnums=(0,))
+    def _rebin1D(self, time_out, shifted_index, kernel, s):
+        # the oversample is read off the kernel shape, so every year is binned in a single reshape and reduction
+        oversample = kernel.shape[0]
+        chunks = dynamic_slice(s, (shifted_index * oversample // 12,), (len(time_out) * oversample,))
+        chunks = chunks.reshape(len(time_out), oversample)
+        binned_data = jnp.sum(jnp.multiply(chunks, kernel), axis=1) / jnp.sum(kernel)
         return binned_data
 
 
@@ -660,19 +734,17 @@ def load_model(filename, production_rate_units='kg/yr', flow_rate_units='Gt/yr')
 
     carbon_box_model.add_nodes(box_object_list)
 
-    for k in range(metadata['fluxes'].shape[0]):
-        for j in range(metadata['fluxes'].shape[1]):
-            if metadata['fluxes'][k, j] != 0:
-                if flow_rate_units == 'Gt/yr':
-                    carbon_box_model.add_edges([Flow(box_object_list[k], box_object_list[j],
-                                                     float(metadata['fluxes'][k, j]))])
-
-                elif flow_rate_units == '1/yr':
-                    new_flow = float(metadata['fluxes'][k, j]) * 12 / 14.003242 / box_object_list[
-                        k].get_reservoir_content()
-                    carbon_box_model.add_edges([Flow(box_object_list[k], box_object_list[j], new_flow)])
-                else:
-                    raise ValueError('flow_rate_units are not valid.')
+    for k, j in zip(*np.nonzero(metadata['fluxes'])):
+        if flow_rate_units == 'Gt/yr':
+            carbon_box_model.add_edges([Flow(box_object_list[k], box_object_list[j],
+                                             float(metadata['fluxes'][k, j]))])
+
+        elif flow_rate_units == '1/yr':
+            new_flow = float(metadata['fluxes'][k, j]) * 12 / 14.003242 / box_object_list[
+                k].get_reservoir_content()
+            carbon_box_model.add_edges([Flow(box_object_list[k], box_object_list[j], new_flow)])
+        else:
+            raise ValueError('flow_rate_units are not valid.')
 
     file.close()
     return carbon_box_model
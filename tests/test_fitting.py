@@ -1,4 +1,8 @@
+import os
+import subprocess
+import sys
 import numpy as np
+import jax
 import jax.numpy as jnp
 import pytest
 import ticktack
@@ -10,6 +14,7 @@ def SingleFitter_creation():
     sf = fitting.SingleFitter(cbm, 'Guttler15', hemisphere="north")
     sf.time_data = jnp.arange(200, 210)
     sf.d14c_data_error = jnp.ones((sf.time_data.size,))
+    sf.d14c_data_inv_error = 1. / sf.d14c_data_error
     sf.d14c_data = jnp.array([-164.90491016, -164.31385509, -164.19279432, -164.57768418,
              -165.33252032, -152.60046413, -150.44363798, -150.40669362,
              -150.88854914, -151.27141576]) # output of simple_sinusoid with data = sf.dc14(true_params)
@@ -21,7 +26,7 @@ def SingleFitter_creation():
     sf.annual = jnp.arange(sf.start, sf.end + 1)
     sf.time_data_fine = jnp.linspace(jnp.min(sf.annual), jnp.max(sf.annual) + 2, (sf.annual.size + 1) * sf.oversample)
     sf.offset = jnp.mean(sf.d14c_data[:4])
-    sf.mask = jnp.isin(sf.annual, sf.time_data)
+    sf.data_index = jnp.searchsorted(sf.annual, sf.time_data)
     sf.growth = sf.get_growth_vector("april-september")
     return sf
 
@@ -107,6 +112,49 @@ def test_MarkovChainSampler(SingleFitter_creation):
                                              )
     assert True
 
+def test_NUTSSampler():
+    cf = fitting.CarbonFitter()
+    chain = cf.NUTSSampler(jnp.array([1., -1.]), lambda params, mu: -0.5 * jnp.sum((params - mu) ** 2),
+                           burnin=100, production=200, num_chains=2, args=(jnp.array([2., 3.]),))
+    assert chain.shape == (400, 2)
+    assert np.allclose(chain.mean(axis=0), [2., 3.], atol=0.5)
+
+def test_sharded(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    params = jnp.array([205., np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)]) + 1e-3 * jnp.arange(
+        2 * jax.local_device_count())[:, None]
+    low_bounds, up_bounds = jnp.array([200., -2, -jnp.pi, -2]), jnp.array([210., 1, jnp.pi, 1.5])
+    batched = SingleFitter_creation.batched(SingleFitter_creation.log_joint_likelihood)
+    sharded = SingleFitter_creation.sharded(batched, n_args=2)
+    assert jnp.allclose(jax.jit(sharded)(params, low_bounds, up_bounds), batched(params, low_bounds, up_bounds))
+
+def test_sharded_odd_half_ensemble():
+    # emcee evaluates half of the 10 walkers at a time, which does not divide across 2 devices
+    script = """
+import jax
+import jax.numpy as jnp
+from ticktack import fitting
+assert jax.local_device_count() == 2
+chain = fitting.CarbonFitter().MarkovChainSampler(jnp.zeros(5), lambda params: -0.5 * jnp.sum(params ** 2),
+                                                  burnin=2, production=2)
+assert chain.shape == (20, 5)
+"""
+    env = dict(os.environ, XLA_FLAGS="--xla_force_host_platform_device_count=2")
+    subprocess.run([sys.executable, "-c", script], env=env, check=True)
+
+def test_MarkovChainSampler_numpy_likelihood():
+    likelihood = lambda params: -0.5 * float(np.sum(np.asarray(params) ** 2))
+    chain = fitting.CarbonFitter().MarkovChainSampler(np.zeros(2), likelihood, burnin=2, production=2,
+                                                      vectorize=False)
+    assert chain.shape == (8, 2)
+
+def test_compile_likelihood(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    first = SingleFitter_creation.compile_likelihood(SingleFitter_creation.log_joint_likelihood, n_args=2)
+    assert SingleFitter_creation.compile_likelihood(SingleFitter_creation.log_joint_likelihood, n_args=2) is first
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    assert SingleFitter_creation.compile_likelihood(SingleFitter_creation.log_joint_likelihood, n_args=2) is not first
+
 # def test_NestedSampler(SingleFitter_creation):
 #     SingleFitter_creation.compile_production_model(model="simple_sinusoid")
 #     SingleFitter_creation.NestedSampler(jnp.array([205.,np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)]),
@@ -130,6 +178,15 @@ def test_interp_gp(SingleFitter_creation):
     out = SingleFitter_creation.interp_gp(201, jnp.ones(SingleFitter_creation.control_points_time.size))
     assert jnp.allclose(out, 1)
 
+def test_interp_gp_matches_tinygp(SingleFitter_creation):
+    from tinygp import kernels, GaussianProcess
+    SingleFitter_creation.compile_production_model(model="control_points")
+    params = jnp.linspace(1., 3., SingleFitter_creation.control_points_time.size)
+    tval = jnp.linspace(200., 209., 25)
+    gp = GaussianProcess(kernels.Matern32(1), SingleFitter_creation.control_points_time, mean=params[0])
+    assert jnp.allclose(SingleFitter_creation.interp_gp(tval, params), gp.condition(params, tval)[1].loc)
+    assert jnp.allclose(SingleFitter_creation.log_likelihood_gp(params), gp.log_probability(params))
+
 def test_simple_sinusoid(SingleFitter_creation):
     out = SingleFitter_creation.simple_sinusoid(200, jnp.array([205., np.log10(1./12), jnp.pi/2., np.log10(81./12)]))
     assert jnp.allclose(out, 2.04261539, rtol=1e-4)
@@ -180,11 +237,125 @@ def test_dc14_fine(SingleFitter_creation):
         ])
     )
 
+def test_burnin_state(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="flexible_sinusoid")
+    params = jnp.array([205., np.log10(1./12), 3., np.log10(81./12), np.log10(0.1)])
+    full = SingleFitter_creation.run_burnin(y0=SingleFitter_creation.steady_state_y0, params=params)[-1, :]
+    assert jnp.allclose(SingleFitter_creation.burnin_state(params), full, rtol=1e-10)
+    early = params.at[0].set(199.)
+    full = SingleFitter_creation.run_burnin(y0=SingleFitter_creation.steady_state_y0, params=early)[-1, :]
+    assert jnp.allclose(SingleFitter_creation.burnin_state(early), full, rtol=1e-10)
+
+def test_burnin_state_not_adaptive(SingleFitter_creation):
+    SingleFitter_creation.adaptive = False
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    assert SingleFitter_creation.burnin_basis is None
+
+def test_dc14_batch(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    params = jnp.array([[205., np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)],
+                        [204., np.log10(2. / 12), 1., np.log10(60./12)]])
+    batch = SingleFitter_creation.dc14_batch(params)
+    assert batch.shape == (2, SingleFitter_creation.time_data.size)
+    for row, param in zip(batch, params):
+        assert jnp.allclose(row, SingleFitter_creation.dc14(params=param))
+
+def test_production_batch(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="control_points")
+    params = jnp.stack([jnp.ones(SingleFitter_creation.control_points_time.size) * 1.76,
+                        jnp.linspace(1.5, 2.5, SingleFitter_creation.control_points_time.size)])
+    batch = SingleFitter_creation.production_batch(SingleFitter_creation.control_points_time_fine, params)
+    assert batch.shape == (2, SingleFitter_creation.control_points_time_fine.size)
+    for row, param in zip(batch, params):
+        assert jnp.allclose(row, SingleFitter_creation.production(SingleFitter_creation.control_points_time_fine, param))
+
+def test_load_data_growth_season(SingleFitter_creation, tmp_path):
+    file_name = tmp_path / "data.csv"
+    file_name.write_text("year,d14c,sig_d14c\n770,-18.1,1.8\n771,-17.3,1.8\n")
+    SingleFitter_creation.load_data(str(file_name), burnin_time=100)
+    assert jnp.all(SingleFitter_creation.growth == SingleFitter_creation.get_growth_vector("april-september"))
+    file_name.write_text("year,d14c,sig_d14c,growth_season\n770,-18.1,1.8,may-july\n771,-17.3,1.8,may-july\n")
+    SingleFitter_creation.load_data(str(file_name), burnin_time=100)
+    assert jnp.all(SingleFitter_creation.growth == SingleFitter_creation.get_growth_vector("may-july"))
+
+def test_load_data_after_compile(SingleFitter_creation, tmp_path):
+    file_name = tmp_path / "data.csv"
+    file_name.write_text("year,d14c,sig_d14c\n" + "".join("{},-18.1,1.8\n".format(year) for year in range(770, 780)))
+    SingleFitter_creation.load_data(str(file_name), burnin_time=100)
+    SingleFitter_creation.compile_production_model(model="flexible_sinusoid")
+    file_name.write_text("year,d14c,sig_d14c\n" + "".join("{},-18.1,1.8\n".format(year) for year in range(774, 784)))
+    SingleFitter_creation.load_data(str(file_name), burnin_time=100)
+    params = jnp.array([778., np.log10(1./12), 3., np.log10(81./12), np.log10(0.1)])
+    full = SingleFitter_creation.run_burnin(y0=SingleFitter_creation.steady_state_y0, params=params)[-1, :]
+    assert jnp.allclose(SingleFitter_creation.burnin_state(params), full, rtol=1e-10)
+
+def test_recompile_production_model(SingleFitter_creation):
+    params = jnp.array([205., np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)])
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    sinusoid = SingleFitter_creation.dc14(params=params)
+    SingleFitter_creation.compile_production_model(model=lambda t, a, b, c, d: 1.76 + 0. * t)
+    flat = SingleFitter_creation.dc14(params=params)
+    assert not jnp.allclose(sinusoid, flat)
+    assert jnp.allclose(flat, flat[0])
+
+@pytest.mark.parametrize("model, params", [
+    ("flexible_sinusoid_affine_variant", [0.1, 795., np.log10(1./12), 3., np.log10(81./12), np.log10(0.1)]),
+    ("control_points", [1.8 + 0.1 * i for i in range(9)]),
+])
+def test_recompile_new_data(tmp_path, model, params):
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    first.write_text("year,d14c,sig_d14c\n" + "".join("{},-18.1,1.8\n".format(year) for year in range(770, 780)))
+    second.write_text("year,d14c,sig_d14c\n" + "".join("{},-18.1,1.8\n".format(year) for year in range(790, 800)))
+    params = jnp.array(params)
+    fitters = []
+    for files in ([first, second], [second]):
+        cbm = ticktack.load_presaved_model('Guttler15', production_rate_units='atoms/cm^2/s')
+        sf = fitting.SingleFitter(cbm, 'Guttler15', hemisphere="north")
+        for file_name in files:
+            sf.load_data(str(file_name), burnin_time=100)
+            sf.compile_production_model(model=model)
+            sf.dc14(params=params)
+        fitters.append(sf)
+    reused, fresh = fitters
+    assert jnp.allclose(reused.dc14(params=params), fresh.dc14(params=params))
+
+def test_clear_jit_caches_per_fitter(SingleFitter_creation):
+    cbm = ticktack.load_presaved_model('Guttler15', production_rate_units='atoms/cm^2/s')
+    other = fitting.SingleFitter(cbm, 'Guttler15', hemisphere="north")
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    dc14 = SingleFitter_creation.dc14
+    other.clear_jit_caches()
+    assert SingleFitter_creation.dc14 is dc14
+    assert other.dc14 is not dc14
+
 def test_log_likelihood(SingleFitter_creation):
     SingleFitter_creation.compile_production_model(model="simple_sinusoid")
     out = SingleFitter_creation.log_likelihood(jnp.array([205.,np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)]))
     assert jnp.allclose(out, -6.27145615, rtol=1e-4)
 
+def test_log_likelihood_float32(SingleFitter_creation, tmp_path):
+    file_name = tmp_path / "data.csv"
+    file_name.write_text("year,d14c,sig_d14c\n" + "".join("{},{},1.\n".format(year, d14c) for year, d14c in zip(
+        np.asarray(SingleFitter_creation.time_data), np.asarray(SingleFitter_creation.d14c_data))))
+    params = jnp.array([205.,np.log10(1. / 12), jnp.pi / 2., np.log10(81./12)])
+    SingleFitter_creation.load_data(str(file_name), burnin_time=1000)
+    SingleFitter_creation.compile_production_model(model="simple_sinusoid")
+    expected = SingleFitter_creation.log_likelihood(params)
+    SingleFitter_creation.load_data(str(file_name), burnin_time=1000, dtype=jnp.float32)
+    assert SingleFitter_creation.d14c_data.dtype == jnp.float32
+    assert SingleFitter_creation.d14c_data_inv_error.dtype == jnp.float32
+    # the offset enters the modelled d14c, which stays in float64
+    assert SingleFitter_creation.offset.dtype == jnp.float64
+    assert SingleFitter_creation.dc14(params=params).dtype == jnp.float64
+    out = SingleFitter_creation.log_likelihood(params)
+    assert out.dtype == jnp.float32
+    assert jnp.allclose(out, expected, rtol=1e-4)
+
+def test_log_prior(SingleFitter_creation):
+    low_bounds, up_bounds = jnp.array([200., -2, -jnp.pi, -2]), jnp.array([210., 1, jnp.pi, 1.5])
+    assert SingleFitter_creation.log_prior(jnp.array([205., -1., 0., 1.]), low_bounds, up_bounds) == 0.
+    assert SingleFitter_creation.log_prior(jnp.array([211., -1., 0., 1.]), low_bounds, up_bounds) == -jnp.inf
+
 def test_log_joint_likelihood(SingleFitter_creation):
     SingleFitter_creation.compile_production_model(model="simple_sinusoid")
     out = SingleFitter_creation.log_joint_likelihood(jnp.array([205.,np.log10(1. / 12), jnp.pi / 2., np.log10(81. / 12)]),
@@ -219,6 +390,15 @@ def test_log_joint_likelihood_gp(SingleFitter_creation):
 #                392.90213745,   334.28333181,   280.16811762,
 #                228.82478265,   163.3669408 ,   135.70935834]))
 
+def test_grad_neg_log_joint_likelihood_gp_finite_difference(SingleFitter_creation):
+    SingleFitter_creation.compile_production_model(model="control_points")
+    params = 1.76 * jnp.ones(SingleFitter_creation.control_points_time.size)
+    out = SingleFitter_creation.grad_neg_log_joint_likelihood_gp(params)
+    step = jnp.zeros(params.size).at[3].set(1e-4)
+    fd = (SingleFitter_creation.neg_log_joint_likelihood_gp(params + step) -
+          SingleFitter_creation.neg_log_joint_likelihood_gp(params - step)) / 2e-4
+    assert jnp.allclose(out[3], fd, rtol=1e-3)
+
 def test_fit_ControlPoints(SingleFitter_creation):
     SingleFitter_creation.compile_production_model(model="control_points")
     SingleFitter_creation.fit_ControlPoints(low_bound=0)
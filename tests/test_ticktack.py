@@ -1,4 +1,5 @@
 import numpy as np
+import jax
 import jax.numpy as jnp
 import pytest
 
@@ -214,7 +215,7 @@ def test_run_bin_october_march():
         binned.append(a)
         actual.append(b)
 
-    assert actual == binned
+    assert np.allclose(actual, binned)
 
 
 def test_run_bin_april_september():
@@ -249,4 +250,47 @@ def test_run_bin_april_september():
         binned.append(a)
         actual.append(b)
 
-    assert actual == binned
+    assert np.allclose(actual, binned)
+
+
+def test_bin_data_too_short():
+    cbm = ticktack.load_presaved_model('Guttler15', production_rate_units='atoms/cm^2/s')
+    cbm.compile()
+    with pytest.raises(ValueError):
+        cbm.bin_data(jnp.arange(36.), 12, jnp.arange(3.), jnp.array([0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0]))
+
+
+def test_run_rk4():
+    cbm = ticktack.load_presaved_model('Guttler15', production_rate_units='atoms/cm^2/s')
+    cbm.compile()
+
+    def production(t, amplitude):
+        return 1.76 + amplitude * jnp.sin(2 * np.pi / 11 * t)
+
+    time = jnp.arange(0., 200., 1.)
+    y0 = cbm.equilibrate(production_rate=1.76)
+    expected, _ = cbm.run(time, production, y0=y0, args=(0.3,), steady_state_production=1.76)
+    actual, _ = cbm.run_rk4(time, production, y0=y0, args=(0.3,), steady_state_production=1.76)
+    assert actual.shape == expected.shape
+    assert jnp.allclose(actual, expected, rtol=1e-8)
+
+
+def test_run_rk4_grad_substeps():
+    cbm = ticktack.load_presaved_model('Guttler15', production_rate_units='atoms/cm^2/s')
+    cbm.compile()
+
+    def production(t, amplitude):
+        return 1.76 + amplitude * jnp.sin(2 * np.pi / 11 * t)
+
+    time = jnp.arange(0., 20., 1.)
+    y0 = cbm.equilibrate(production_rate=1.76)
+
+    def final_troposphere(amplitude, substeps):
+        box_values, _ = cbm.run_rk4(time, production, y0=y0, args=(amplitude,), steady_state_production=1.76,
+                                    substeps=substeps)
+        return box_values[-1, 1]
+
+    coarse = jax.grad(final_troposphere)(0.3, 48)
+    fine = jax.grad(final_troposphere)(0.3, 96)
+    assert jnp.isfinite(fine)
+    assert jnp.allclose(coarse, fine, rtol=1e-8)